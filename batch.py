@@ -0,0 +1,94 @@
+import argparse
+import os
+import random
+import statistics
+import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import main
+
+# ---------- GLOBAL ----------
+
+
+MOVES = [['d'], ['d'], ['d', 'space'], ['a'], ['a', 'space'], ['space'], []]
+
+
+# -------- FUNCTIONS ---------
+
+
+def random_script(seed, max_ticks):
+    rng = random.Random(seed)
+    script, total = [], 0
+    while total < max_ticks:
+        ticks = rng.randint(1, 30)
+        script.append((ticks, rng.choice(MOVES)))
+        total += ticks
+    return script
+
+
+def init_worker():
+    main.init(headless=True)
+
+
+def play(job):
+    source, levels, max_ticks = job
+    if isinstance(source, int):
+        script = random_script(source, max_ticks)
+    else:
+        script = main.read_script(source)
+    result = main.simulate(script, levels, max_ticks)
+    result['source'] = source
+    return result
+
+
+def percentiles(values):
+    if len(values) < 2:
+        return values
+    q = statistics.quantiles(values, n=4)
+    return [min(values), q[0], q[1], q[2], max(values)]
+
+
+def report(results):
+    outcomes = Counter(result['outcome'] for result in results)
+    wins = [result for result in results if result['outcome'] == 'win']
+    print(f"Прогонов: {len(results)}")
+    print(f"Исходы: {dict(outcomes)}")
+    print(f"Доля побед: {len(wins) / len(results):.1%}")
+    if wins:
+        print("Кислород на финише (min/25%/50%/75%/max):",
+              ' / '.join(f"{value:g}" for value in percentiles([result['oxy'] for result in wins])))
+        ticks = [result['ticks'] for result in wins]
+        print(f"Тиков до победы: среднее {statistics.mean(ticks):.1f}, "
+              f"медиана {statistics.median(ticks):g}, min {min(ticks)}, max {max(ticks)}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Пакетный прогон уровней без окна")
+    parser.add_argument('scripts', nargs='*', help="файлы сценариев или записанных реплеев")
+    parser.add_argument('--random', type=int, default=0, help="число прогонов со случайным вводом")
+    parser.add_argument('--seed', type=int, default=0, help="начальное зерно случайных прогонов")
+    parser.add_argument('--level', action='append', help="уровень из data/, можно несколько раз")
+    parser.add_argument('--max-ticks', type=int, default=10000)
+    parser.add_argument('--workers', type=int, default=None, help="число процессов (по умолчанию - все ядра)")
+    return parser.parse_args()
+
+
+# ---------- RUNNER ----------
+
+
+def run():
+    args = parse_args()
+    levels = args.level or main.maps
+    sources = args.scripts + list(range(args.seed, args.seed + args.random))
+    if not sources:
+        print("Нечего запускать: укажите сценарии или --random N")
+        sys.exit(1)
+    jobs = [(source, levels, args.max_ticks) for source in sources]
+    with ProcessPoolExecutor(args.workers, initializer=init_worker) as pool:
+        results = list(pool.map(play, jobs, chunksize=max(1, len(jobs) // (8 * (os.cpu_count() or 1)))))
+    report(results)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,175 @@
+import argparse
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import cycle
+from time import perf_counter
+
+import main
+
+# ---------- GLOBAL ----------
+
+
+SIZES = [(56, 28), (200, 100), (500, 500), (1000, 1000)]
+QUICK_SIZES = [(56, 28), (200, 100)]
+DENSITIES = [0.01, 0.05]
+TICKS = 600
+FRAMES = 200
+SEEKERS = 20
+PATROL = [(20, ['d']), (5, ['d', 'space']), (20, ['a']), (5, ['a', 'space'])]
+
+
+# -------- FUNCTIONS ---------
+
+
+def generate_level(cols, rows, density, seed=0):
+    # уровень в формате load_level: стены по краям, полки кораллов, генераторы на полках
+    rng = random.Random(seed)
+    cells = [['.'] * cols for _ in range(rows)]
+    for x in range(cols):
+        cells[0][x] = cells[rows - 1][x] = '#'
+    for y in range(rows):
+        cells[y][0] = cells[y][cols - 1] = '#'
+    for y in range(4, rows - 1, 4):
+        x = 1
+        while x < cols - 1:
+            length = rng.randint(2, 8)
+            if rng.random() < 0.5:
+                for i in range(x, min(x + length, cols - 1)):
+                    cells[y][i] = '%'
+            x += length + rng.randint(1, 4)
+    for y in range(1, rows - 1):
+        for x in range(1, cols - 1):
+            if cells[y][x] == '.' and ord(cells[y + 1][x]) in main.SOLID_CELLS and rng.random() < density:
+                cells[y][x] = '$'
+    cells[rows - 2][1] = '@'
+    cells[rows - 2][cols - 2] = '-'
+    return [''.join(row) for row in cells]
+
+
+def write_level(directory, cols, rows, density):
+    filename = os.path.join(directory, f"bench_{cols}x{rows}_{density}.txt")
+    with open(filename, 'w') as level_file:
+        level_file.write('\n'.join(generate_level(cols, rows, density)))
+    return filename
+
+
+def peak_rss_mb():
+    # ru_maxrss в килобайтах на Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def bench_case(case):
+    filename, cols, rows, density = case
+    result = {'case': f"{cols}x{rows}@{density}"}
+
+    start = perf_counter()
+    level = main.Map(filename)
+    main.init_groups()
+    main.turtle, *main.map_size = level.generate_map(render=False)
+    result['load_s'] = perf_counter() - start
+    result['generators'] = sum(kind == ord('$') for kind, x, y in level.entities)
+
+    compiled = os.path.splitext(filename)[0] + '.lvl'
+    main.compile_level(filename, compiled)
+    start = perf_counter()
+    main.Map(compiled)
+    result['load_lvl_s'] = perf_counter() - start
+
+    # черепаха бессмертна, чтобы мерить ровно TICKS тиков
+    main.turtle.hp = main.turtle.hp_max = 10 ** 9
+    controls = main.ScriptedInput(cycle(PATROL))
+    start = perf_counter()
+    for _ in range(TICKS):
+        main.step(controls.next_keys())
+    result['ticks_per_s'] = TICKS / (perf_counter() - start)
+
+    # существа с ИИ в открытой воде вокруг черепахи: тики вместе с поиском пути по полям направлений
+    rng = random.Random(0)
+    grid, radius = main.level_grid, main.NAV_RADIUS
+    col, row = main.turtle.rect.centerx // main.T_WIDTH, main.turtle.rect.centery // main.T_HEIGHT
+    water = [(x, y) for y in range(max(0, row - radius), min(grid.rows, row + radius + 1))
+             for x in range(max(0, col - radius), min(grid.cols, col + radius + 1))
+             if grid.data[y * grid.cols + x] not in main.SOLID_CELLS]
+    for x, y in rng.sample(water, min(SEEKERS, len(water))):
+        main.Seeker(x, y, main.turtle_anim)
+    start = perf_counter()
+    for _ in range(TICKS):
+        main.step(controls.next_keys())
+    result['seekers_ticks_per_s'] = TICKS / (perf_counter() - start)
+
+    # чанки слоя пекутся по мере надобности, поэтому отдельно меряем первый кадр
+    start = perf_counter()
+    main.start_level(filename)
+    main.turtle.hp = main.turtle.hp_max = 10 ** 9
+    main.camera = main.Camera()
+    main.draw_frame()
+    result['first_frame_s'] = perf_counter() - start
+    start = perf_counter()
+    for _ in range(FRAMES):
+        main.step(controls.next_keys())
+        main.draw_frame()
+        main.pygame.display.flip()
+    result['fps'] = FRAMES / (perf_counter() - start)
+
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+def compare(results, baseline):
+    for result in results:
+        old = baseline.get(result['case'])
+        line = ', '.join(f"{key} {value:.4g}" for key, value in result.items() if key != 'case')
+        print(f"{result['case']:>18}: {line}")
+        if old is None:
+            continue
+        deltas = []
+        for key, value in result.items():
+            if key in ('case', 'generators') or not old.get(key):
+                continue
+            deltas.append(f"{key} {(value - old[key]) / old[key]:+.1%}")
+        print(f"{'':>18}  к базе: {', '.join(deltas)}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Замеры загрузки, тиков и отрисовки на синтетических уровнях")
+    parser.add_argument('--quick', action='store_true', help="только небольшие уровни")
+    parser.add_argument('--baseline', default='bench_baseline.json', help="файл с базовыми результатами")
+    parser.add_argument('--save', action='store_true', help="записать результаты как новую базу")
+    return parser.parse_args()
+
+
+# ---------- RUNNER ----------
+
+
+def run():
+    args = parse_args()
+    sizes = QUICK_SIZES if args.quick else SIZES
+    with tempfile.TemporaryDirectory() as directory:
+        cases = [(write_level(directory, cols, rows, density), cols, rows, density)
+                 for cols, rows in sizes for density in DENSITIES]
+        # каждый замер в свежем процессе, чтобы пиковая память не смешивалась
+        with ProcessPoolExecutor(1, initializer=main.init, initargs=(True,),
+                                 max_tasks_per_child=1) as pool:
+            results = list(pool.map(bench_case, cases))
+
+    baseline = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+    compare(results, baseline)
+    if args.save:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump({result['case']: result for result in results}, baseline_file, indent=2)
+        print(f"База сохранена в {args.baseline}")
+
+
+if __name__ == '__main__':
+    if sys.version_info < (3, 11):
+        print("Нужен Python 3.11+ (max_tasks_per_child)")
+        sys.exit(1)
+    run()
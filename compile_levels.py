@@ -0,0 +1,18 @@
+import argparse
+import os
+
+import main
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Компиляция текстовых уровней из data/ в формат .lvl")
+    parser.add_argument('levels', nargs='*', help="файлы уровней в data/ (по умолчанию - все из main.maps)")
+    args = parser.parse_args()
+    for level in args.levels or main.maps:
+        output = os.path.splitext(level)[0] + '.lvl'
+        main.compile_level(level, output)
+        print(f"{level} -> {output}")
+
+
+if __name__ == '__main__':
+    run()
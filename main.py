@@ -1,7 +1,16 @@
 import pygame
+import atexit
+import csv
+import json
+import mmap
 import os
+import struct
 import sys
-import pymorphy2
+import threading
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
 
 # ---------- GLOBAL ----------
 
@@ -10,7 +19,34 @@ WIDTH, HEIGHT = 800, 600
 SIZE = WIDTH, HEIGHT
 CLOCK = pygame.time.Clock()
 T_WIDTH = T_HEIGHT = 50
-FPS = 30
+FPS = 60
+TICK_RATE = 30
+TICK_MS = 1000 / TICK_RATE
+MAX_FRAME_MS = 250
+CHUNK_SIZE = 16
+ACTIVE_RADIUS = 1
+KEEP_RADIUS = 2
+# поля направлений считаются в окне вокруг цели: за его пределами мобы всё равно выгружены
+NAV_RADIUS = (KEEP_RADIUS + 1) * CHUNK_SIZE
+NAV_CACHE = 8
+SOLID_CELLS = b'#%'
+WIN_CELLS = b'-'
+OXY_CELLS = b'^'
+ENTITY_CELLS = b'$@'
+STATIC_TEXTURES = {ord('#'): 'wall', ord('%'): 'coral'}
+# скомпилированный уровень: заголовок, сетка клеток по байту, таблица сущностей
+LEVEL_MAGIC = b'TLVL'
+LEVEL_HEADER = struct.Struct('<4sIII')
+LEVEL_ENTITY = struct.Struct('<BII')
+TEXTURES = {
+    'empty': 'empty.png',
+    'wall': 'sand_type1.png',
+    'coral': 'sand_type2.png',
+    'err': 'err.png',
+    'bubblegen': 'bubblegen.png',
+    'bg': 'bg.jpg'
+}
+TEXTURE_SIZES = {'bg': (1200, 600)}
 
 
 # ---------- GROUPS ----------
@@ -18,24 +54,14 @@ FPS = 30
 
 def init_groups():
     global all_sprites, \
-        tile_sprites, \
-        solid_sprites, \
-        win_sprites, \
         mob_sprites, \
-        obj_sprites, \
         bubble_gen_sprites, \
-        bubbles_sprites, \
-        oxytile_sprites
+        ai_sprites
 
     all_sprites = pygame.sprite.Group()
-    tile_sprites = pygame.sprite.Group()
-    solid_sprites = pygame.sprite.Group()
-    win_sprites = pygame.sprite.Group()
     mob_sprites = pygame.sprite.Group()
-    obj_sprites = pygame.sprite.Group()
     bubble_gen_sprites = pygame.sprite.Group()
-    bubbles_sprites = pygame.sprite.Group()
-    oxytile_sprites = pygame.sprite.Group()
+    ai_sprites = pygame.sprite.Group()
 
 
 init_groups()
@@ -44,7 +70,11 @@ init_groups()
 # -------- FUNCTIONS ---------
 
 
-def load_image(name, colorkey=None):
+def load_image(name, colorkey=None, size=None):
+    return asset_cache.get(name, colorkey, size)
+
+
+def read_image(name, colorkey=None):
     fullname = os.path.join('data', name)
     # если файл не существует, то выходим
     if not os.path.isfile(fullname):
@@ -61,8 +91,25 @@ def load_image(name, colorkey=None):
     return image
 
 
+def cut_sheet(sheet, columns, rows):
+    frame = pygame.Rect(0, 0, sheet.get_width() // columns, sheet.get_height() // rows)
+    return [sheet.subsurface(frame.move(frame.w * i, frame.h * j))
+            for j in range(rows) for i in range(columns)]
+
+
+def read_script(filename):
+    # строки сценария: "<тики> <клавиши>", например "30 d space"
+    script = []
+    with open(filename, 'r') as script_file:
+        for line in script_file:
+            if line.strip():
+                ticks, *keys = line.split()
+                script.append((int(ticks), keys))
+    return script
+
+
 def load_level(filename):
-    filename = "data/" + filename
+    filename = os.path.join('data', filename)
 
     with open(filename, 'r') as mapFile:
         level_map = [line.strip() for line in mapFile]
@@ -71,123 +118,643 @@ def load_level(filename):
     return list(map(lambda x: x.ljust(max_width, '.'), level_map))
 
 
+def chunks_around(grid, center, radius):
+    cx, cy = center
+    cols = (grid.cols + CHUNK_SIZE - 1) // CHUNK_SIZE
+    rows = (grid.rows + CHUNK_SIZE - 1) // CHUNK_SIZE
+    return {(x, y) for x in range(max(0, cx - radius), min(cols, cx + radius + 1))
+            for y in range(max(0, cy - radius), min(rows, cy + radius + 1))}
+
+
+def find_entities(cells, cols):
+    return [(kind, i % cols, i // cols) for i, kind in enumerate(cells) if kind in ENTITY_CELLS]
+
+
+def compile_level(filename, output):
+    level_map = load_level(filename)
+    rows, cols = len(level_map), len(level_map[0])
+    cells = ''.join(level_map).encode()
+    entities = find_entities(cells, cols)
+    with open(os.path.join('data', output), 'wb') as level_file:
+        level_file.write(LEVEL_HEADER.pack(LEVEL_MAGIC, cols, rows, len(entities)))
+        level_file.write(cells)
+        for entity in entities:
+            level_file.write(LEVEL_ENTITY.pack(*entity))
+
+
+def load_compiled_level(filename):
+    filename = os.path.join('data', filename)
+    # сетка не копируется: TileGrid читает прямо из отображённого в память файла
+    with open(filename, 'rb') as level_file:
+        view = memoryview(mmap.mmap(level_file.fileno(), 0, access=mmap.ACCESS_READ))
+    magic, cols, rows, count = LEVEL_HEADER.unpack_from(view)
+    if magic != LEVEL_MAGIC:
+        print(f"Файл '{filename}' не является скомпилированным уровнем")
+        sys.exit()
+    start = LEVEL_HEADER.size + cols * rows
+    cells = view[LEVEL_HEADER.size:start]
+    entities = list(LEVEL_ENTITY.iter_unpack(view[start:start + count * LEVEL_ENTITY.size]))
+    return cells, cols, rows, entities
+
+
 # --------- CLASSES ----------
 
 
+class AssetCache:
+    # общий кэш картинок и их масштабированных вариантов; уровень готовится и в фоновом потоке,
+    # поэтому декодирование, вставка и счётчики идут под замком (RLock: вариант берёт оригинал из кэша)
+    def __init__(self):
+        self.surfaces = {}
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self.lock = threading.RLock()
+
+    def get(self, name, colorkey=None, size=None):
+        key = (name, size, colorkey, colorkey is None)
+        with self.lock:
+            if key in self.surfaces:
+                self.hits += 1
+                return self.surfaces[key]
+            self.misses += 1
+            if size is None:
+                image = read_image(name, colorkey)
+            else:
+                image = pygame.transform.scale(self.get(name, colorkey), size)
+            self.surfaces[key] = image
+            self.bytes += image.get_bytesize() * image.get_width() * image.get_height()
+            return image
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'surfaces': len(self.surfaces), 'bytes': self.bytes}
+
+
+asset_cache = AssetCache()
+
+
+class AnimationRegistry:
+    # каждый лист анимации режется на кадры один раз, экземпляры хранят только ссылку;
+    # все зарегистрированные листы упакованы в одну поверхность-атлас, кадры - её подповерхности
+    def __init__(self):
+        self.atlases = {}
+        self.known = []
+
+    def register(self, *sheet_sets):
+        self.known.extend(tuple(sheets) for sheets in sheet_sets)
+
+    def pack(self, sheet_sets):
+        # листы кладутся друг под другом, общие файлы - один раз
+        images = {file: load_image(file) for sheets in sheet_sets for name, file, cols, rows in sheets}
+        size = (max(image.get_width() for image in images.values()),
+                sum(image.get_height() for image in images.values()))
+        surface = pygame.Surface(size, pygame.SRCALPHA).convert_alpha()
+        packed, top = {}, 0
+        for file, image in images.items():
+            # BLEND_RGBA_MAX по прозрачному фону копирует пиксели вместе с альфой, без смешивания
+            surface.blit(image, (0, top), special_flags=pygame.BLEND_RGBA_MAX)
+            packed[file] = surface.subsurface((0, top), image.get_size())
+            top += image.get_height()
+        for sheets in sheet_sets:
+            atlas = {'err': [assets['err']]}
+            for name, file, cols, rows in sheets:
+                atlas[name] = cut_sheet(packed[file], cols, rows)
+            self.atlases[sheets] = atlas
+
+    def get(self, sheets):
+        key = tuple(sheets)
+        if key not in self.atlases:
+            # при первом запросе пакуются сразу все зарегистрированные листы,
+            # незарегистрированный набор получает отдельный атлас
+            pending = [known for known in self.known if known not in self.atlases]
+            self.pack(pending if key in pending else [key])
+        return self.atlases[key]
+
+
+animations = AnimationRegistry()
+
+
+class Assets(dict):
+    # текстуры по имени грузятся при первом обращении, а не при импорте
+    def __missing__(self, name):
+        self[name] = load_image(TEXTURES[name], size=TEXTURE_SIZES.get(name))
+        return self[name]
+
+
+assets = Assets()
+
+
+class Trace:
+    # отладочный канал по категориям; выключенная категория стоит одной проверки атрибута,
+    # включённая пишет события в кольцевой буфер, а при заданном файле - пачками в файл
+    CATEGORIES = ('physics', 'collision', 'bubbles')
+
+    def __init__(self, size=4096):
+        self.events = deque(maxlen=size)
+        self.file = None
+        for category in self.CATEGORIES:
+            setattr(self, category, False)
+
+    def enable(self, categories, file=None):
+        for category in categories:
+            if category in self.CATEGORIES:
+                setattr(self, category, True)
+        if file is not None and self.file is None:
+            atexit.register(self.flush)
+        self.file = file
+
+    def emit(self, category, *args):
+        self.events.append((category, args))
+        if self.file is not None and len(self.events) == self.events.maxlen:
+            self.flush()
+
+    def flush(self):
+        if self.file is None:
+            return
+        with open(self.file, 'a') as trace_file:
+            for category, args in self.events:
+                trace_file.write(' '.join(map(str, (category, *args))) + '\n')
+        self.events.clear()
+
+
+trace = Trace()
+if os.environ.get('TURTLE_TRACE'):
+    # например TURTLE_TRACE=physics,bubbles TURTLE_TRACE_FILE=trace.log
+    trace.enable(os.environ['TURTLE_TRACE'].split(','), os.environ.get('TURTLE_TRACE_FILE'))
+
+
+class PressedKeys(frozenset):
+    # то же, что pygame.key.get_pressed(), но из набора кодов клавиш
+    def __getitem__(self, key):
+        return key in self
+
+
+class ScriptedInput:
+    # ввод по сценарию [(тики, клавиши), ...]; поток реплея - тот же сценарий по одному тику
+    KEYS = {'a': pygame.K_a, 'd': pygame.K_d, 'space': pygame.K_SPACE, 'g': pygame.K_g}
+
+    def __init__(self, script):
+        self.script = iter(script)
+        self.keys = PressedKeys()
+        self.left = 0
+
+    def next_keys(self):
+        while self.left <= 0:
+            ticks, keys = next(self.script, (None, ()))
+            if ticks is None:
+                # сценарий закончился - клавиши отпущены
+                self.keys, self.left = PressedKeys(), float('inf')
+                break
+            self.keys = PressedKeys(self.KEYS[key] for key in keys)
+            self.left = ticks
+        self.left -= 1
+        return self.keys
+
+
 class Camera:
+    # смещение из мировых координат в экранные, сами спрайты не двигаются
     def __init__(self):
         self.dx = 0
         self.dy = 0
 
-    def apply(self, obj):
-        obj.rect.x += self.dx
-        obj.rect.y += self.dy
+    def apply(self, rect):
+        return rect.move(self.dx, self.dy)
+
+    def draw(self, group, surface, alpha=1.0):
+        # видимые спрайты собираются и рисуются одним вызовом blits
+        view = surface.get_clip()
+        blits = []
+        for sprite in group:
+            rect = self.apply(sprite.lerp(alpha) if isinstance(sprite, Mob) else sprite.rect)
+            if view.colliderect(rect):
+                blits.append((sprite.image, rect))
+        surface.blits(blits, doreturn=False)
+        return len(blits)
+
+    def update(self, target, alpha=1.0):
+        rect = target.lerp(alpha)
+        self.dx = -(rect.x + rect.w // 2 - WIDTH // 2)
+        self.dy = -(rect.y + rect.h // 2 - HEIGHT // 2)
+
+
+class TileGrid:
+    # индекс клеток уровня: запрос по прямоугольнику смотрит только задетые клетки
+    def __init__(self, cells, cols, rows):
+        # cells - коды клеток построчно: bytes или memoryview над скомпилированным уровнем
+        self.data = cells
+        self.rows, self.cols = rows, cols
+
+    def cell_rect(self, col, row):
+        return pygame.Rect(col * T_WIDTH, row * T_HEIGHT, T_WIDTH, T_HEIGHT)
+
+    def cells(self, rect):
+        left = max(0, rect.left // T_WIDTH)
+        right = min(self.cols - 1, (rect.right - 1) // T_WIDTH)
+        top = max(0, rect.top // T_HEIGHT)
+        bottom = min(self.rows - 1, (rect.bottom - 1) // T_HEIGHT)
+        for row in range(top, bottom + 1):
+            line = row * self.cols
+            for col in range(left, right + 1):
+                yield col, row, self.data[line + col]
+
+    def collide(self, rect, kinds=SOLID_CELLS):
+        return [(self.cell_rect(col, row), kind) for col, row, kind in self.cells(rect) if kind in kinds]
+
+    def sweep(self, rect, dx, dy, kinds=SOLID_CELLS):
+        # сдвиг rect вдоль одной оси (dx или dy равен 0) до первой клетки kinds на пути;
+        # смотрятся только линии клеток, которые пересечёт передний край, поэтому сквозь тайл не проскочить
+        if dx:
+            delta, low, high, size, count, stride, pitch = dx, rect.left, rect.right, T_WIDTH, self.cols, 1, self.cols
+            across = range(max(0, rect.top // T_HEIGHT), min(self.rows, (rect.bottom - 1) // T_HEIGHT + 1))
+        else:
+            delta, low, high, size, count, stride, pitch = dy, rect.top, rect.bottom, T_HEIGHT, self.rows, self.cols, 1
+            across = range(max(0, rect.left // T_WIDTH), min(self.cols, (rect.right - 1) // T_WIDTH + 1))
+        if delta > 0:
+            lines = range(max(0, (high - 1) // size + 1), min(count, (high + delta - 1) // size + 1))
+        else:
+            lines = range(min(count - 1, low // size - 1), max(-1, (low + delta) // size - 1), -1)
+        for line in lines:
+            if any(self.data[line * stride + i * pitch] in kinds for i in across):
+                return line * size - high if delta > 0 else (line + 1) * size - low
+        return delta
+
+
+class StaticLayer:
+    # неподвижная геометрия уровня, запечённая в поверхности-чанки по мере надобности
+    def __init__(self, grid, prefetch=True):
+        self.grid = grid
+        self.chunk_w, self.chunk_h = CHUNK_SIZE * T_WIDTH, CHUNK_SIZE * T_HEIGHT
+        self.chunks = {}
+        self.pending = {}
+        self.prefetch = prefetch
+        # чанки пекутся и в фоновом потоке, и в главном. Поэтому у слоя свои копии текстур,
+        # которые читает только bake_chunk, и запекание идёт под замком. Чанк рисуется в новую
+        # поверхность, и главный поток видит её только через future.result() или после возврата
+        self.textures = {kind: load_image(TEXTURES[name], size=(T_WIDTH, T_HEIGHT)).copy()
+                         for kind, name in STATIC_TEXTURES.items()}
+        self.lock = threading.Lock()
+
+    def bake_chunk(self, cx, cy):
+        chunk = None
+        area = pygame.Rect(cx * self.chunk_w, cy * self.chunk_h, self.chunk_w, self.chunk_h)
+        with self.lock:
+            for col, row, kind in self.grid.cells(area):
+                if kind not in self.textures:
+                    continue
+                if chunk is None:
+                    chunk = pygame.Surface(area.size, pygame.SRCALPHA)
+                chunk.blit(self.textures[kind], (col * T_WIDTH - area.x, row * T_HEIGHT - area.y))
+        return chunk
+
+    def chunk(self, key):
+        # пустой чанк хранится как None, чтобы не перепекать его
+        if key not in self.chunks:
+            future = self.pending.pop(key, None)
+            if future is not None and not future.cancel():
+                # уже печётся или готов
+                self.chunks[key] = future.result()
+            else:
+                # не заказан или стоит в очереди за другими задачами - печём сразу, кадр не ждёт очередь
+                self.chunks[key] = self.bake_chunk(*key)
+        return self.chunks[key]
+
+    def retain(self, keep, wanted):
+        for key in [key for key in self.chunks if key not in keep]:
+            del self.chunks[key]
+        for key in [key for key in self.pending if key not in keep]:
+            self.pending.pop(key).cancel()
+        if not self.prefetch:
+            return
+        for key in wanted:
+            if key not in self.chunks and key not in self.pending:
+                self.pending[key] = background_loader.submit(self.bake_chunk, *key)
+
+    def draw(self, surface, camera):
+        # только чанки, задевающие область отсечения экрана
+        view = surface.get_clip().move(-camera.dx, -camera.dy)
+        blits = 0
+        for cy in range(max(0, view.top // self.chunk_h), (view.bottom - 1) // self.chunk_h + 1):
+            for cx in range(max(0, view.left // self.chunk_w), (view.right - 1) // self.chunk_w + 1):
+                chunk = self.chunk((cx, cy))
+                if chunk is not None:
+                    surface.blit(chunk, (cx * self.chunk_w + camera.dx, cy * self.chunk_h + camera.dy))
+                    blits += 1
+        return blits
+
+
+# фоновый поток для запекания чанков и подготовки следующего уровня
+background_loader = ThreadPoolExecutor(1)
+
+
+def prepare_level(map_file, render=True):
+    level = Map(map_file)
+    layer = None
+    if render:
+        layer = StaticLayer(level.grid)
+        for kind, x, y in level.entities:
+            if kind == ord('@'):
+                for key in chunks_around(level.grid, (x // CHUNK_SIZE, y // CHUNK_SIZE), ACTIVE_RADIUS):
+                    layer.chunk(key)
+    return level, layer
+
+
+class LevelPreloader:
+    # следующий уровень разбирается и запекается вокруг старта, пока играется текущий
+    def __init__(self):
+        self.key = None
+        self.future = None
 
-    def update(self, target):
-        self.dx = -(target.rect.x + target.rect.w // 2 - WIDTH // 2)
-        self.dy = -(target.rect.y + target.rect.h // 2 - HEIGHT // 2)
+    def start(self, map_file, render=True):
+        if self.future is not None and self.key == (map_file, render):
+            # этот уровень уже заказан или готов
+            return
+        self.key = (map_file, render)
+        self.future = background_loader.submit(prepare_level, map_file, render)
+
+    def take(self, map_file, render=True):
+        future, self.future = self.future, None
+        if future is not None and self.key == (map_file, render) and not future.cancel():
+            return future.result()
+        # не заказан или ещё не начат - грузим сразу
+        return prepare_level(map_file, render)
+
+
+preloader = LevelPreloader()
+
+
+class TimingWheel:
+    # отложенные события по тикам: сущность ничего не стоит, пока не наступил её тик
+    def __init__(self, size=64):
+        self.slots = [[] for _ in range(size)]
+        self.now = 0
+
+    def schedule(self, entity, delay):
+        due = self.now + delay
+        self.slots[due % len(self.slots)].append((due, entity))
+        return due
+
+    def reset(self, now):
+        # перемотка к тику снимка: все записи снимаются, сущности планируются заново
+        self.slots = [[] for _ in self.slots]
+        self.now = now
+
+    def advance(self):
+        # записи, у которых entity.due уже другой (сущность уснула или перепланирована), пропускаются
+        self.now += 1
+        slot = self.slots[self.now % len(self.slots)]
+        ready = []
+        for tick, entity in slot:
+            if tick == self.now and entity.due == tick:
+                # повторная запись на тот же тик (после sleep и wake) не сработает второй раз
+                entity.due = None
+                ready.append(entity)
+        slot[:] = [(tick, entity) for tick, entity in slot if tick > self.now]
+        return ready
+
+
+class FlowField:
+    # куда шагать к цели из каждой проходимой клетки окна, один обход в ширину от цели
+    STEPS = ((0, 0), (1, 0), (-1, 0), (0, 1), (0, -1))
+
+    def __init__(self, grid, target, radius):
+        col, row = target
+        self.left, self.top = max(0, col - radius), max(0, row - radius)
+        self.width = min(grid.cols, col + radius + 1) - self.left
+        self.height = min(grid.rows, row + radius + 1) - self.top
+        # индекс в STEPS; 0 - цель, стена или клетка, до которой не добраться
+        self.flow = bytearray(self.width * self.height)
+        seen = bytearray(self.width * self.height)
+        start = (row - self.top) * self.width + col - self.left
+        seen[start] = 1
+        queue = deque([start])
+        while queue:
+            y, x = divmod(queue.popleft(), self.width)
+            for code in range(1, len(self.STEPS)):
+                # сосед, из которого шаг STEPS[code] ведёт в текущую клетку
+                dx, dy = self.STEPS[code]
+                nx, ny = x - dx, y - dy
+                if not (0 <= nx < self.width and 0 <= ny < self.height):
+                    continue
+                i = ny * self.width + nx
+                if seen[i]:
+                    continue
+                seen[i] = 1
+                if grid.data[(ny + self.top) * grid.cols + nx + self.left] in SOLID_CELLS:
+                    continue
+                self.flow[i] = code
+                queue.append(i)
+
+    def direction(self, col, row):
+        x, y = col - self.left, row - self.top
+        if 0 <= x < self.width and 0 <= y < self.height:
+            return self.STEPS[self.flow[y * self.width + x]]
+        return self.STEPS[0]
+
+
+class Navigator:
+    # поля направлений к клетке черепахи: строятся по первому запросу мобов
+    # и кэшируются по клетке цели, пока черепаха в той же клетке - поиск не нужен
+    def __init__(self, grid, radius=NAV_RADIUS, size=NAV_CACHE):
+        self.grid = grid
+        self.radius = radius
+        self.size = size
+        self.fields = {}
+        self.target = None
+        self.current = None
+
+    def track(self, rect):
+        cell = (rect.centerx // T_WIDTH, rect.centery // T_HEIGHT)
+        if cell != self.target:
+            self.target = cell
+            self.current = None
+
+    def field(self):
+        if self.current is None:
+            field = self.fields.pop(self.target, None)
+            if field is None:
+                field = FlowField(self.grid, self.target, self.radius)
+                if len(self.fields) >= self.size:
+                    del self.fields[next(iter(self.fields))]
+            # недавно нужные поля вытесняются последними
+            self.fields[self.target] = self.current = field
+        return self.current
+
+    def steer(self, rect):
+        return self.field().direction(rect.centerx // T_WIDTH, rect.centery // T_HEIGHT)
 
 
 class Tile(pygame.sprite.Sprite):
-    def __init__(self, texture='empty', x=0, y=0, passable=False):
-        super(Tile, self).__init__(all_sprites, tile_sprites)
-        if not passable:
-            self.add(solid_sprites)
-            self.image = pygame.transform.scale(assets[texture], (T_WIDTH, T_HEIGHT))
-        else:
-            self.image = assets[texture]
-        self.passable = passable
+    # стены и кораллы запекаются в StaticLayer, спрайтами остаются только живые клетки
+    def __init__(self, texture='empty', x=0, y=0):
+        super(Tile, self).__init__(all_sprites)
+        self.image = assets[texture]
         self.rect = self.image.get_rect().move(x * T_WIDTH, y * T_HEIGHT)
 
 
-class WinTile(Tile):
-    def __init__(self, texture='empty', x=0, y=0, passable=False):
-        super().__init__(texture, x, y, passable)
-        self.add(win_sprites)
+class BubbleGenerator(Tile):
+    cd_max = 22
 
+    def __init__(self, texture='empty', x=0, y=0):
+        super().__init__(texture, x, y)
+        self.add(bubble_gen_sprites)
+        self.due = None
 
-class OxyTile(Tile):
-    def __init__(self, texture='empty', x=0, y=0, passable=False):
-        super().__init__(texture, x, y, passable)
-        self.add(oxytile_sprites)
+    @property
+    def countdown(self):
+        return self.cd_max + 1 - (self.due - level_wheel.now)
 
+    def wake(self, delay):
+        # пузырь появится через delay тиков, до этого генератор не обновляется
+        self.due = level_wheel.schedule(self, delay)
 
-class BubbleGenerator(Tile):
-    def __init__(self, texture='empty', x=0, y=0, passable=False):
-        super().__init__(texture, x, y, passable)
-        self.add(bubble_gen_sprites)
-        self.bubbles = []
-        self.cd_max = 22
-        self.countdown = 0
+    def sleep(self):
+        self.due = None
 
     def generate_bubble(self):
-        new = Bubble(*self.rect.midtop, bubble_anim, 20)
-        self.bubbles.append(new)
+        level_bubbles.spawn(*self.rect.midtop, 20)
 
-    def update(self):
-        if self.countdown >= self.cd_max:
-            self.generate_bubble()
-            self.countdown = -1
-        self.countdown += 1
+    def fire(self):
+        self.generate_bubble()
+        self.wake(self.cd_max + 1)
 
 
 class Map:
     def __init__(self, map_file):
-        self.map_list = load_level(map_file)
-        self.size_x, self.size_y = len(self.map_list), len(self.map_list[0])
-        self.tiles = []
-
-    def generate_map(self):
-        turtle_obj, x, y = None, None, None
-        for y in range(len(self.map_list)):
-            for x in range(len(self.map_list[y])):
-                if self.map_list[y][x] == '.':
-                    tile = Tile('empty', x, y, True)
-                elif self.map_list[y][x] == '#':
-                    tile = Tile('wall', x, y)
-                elif self.map_list[y][x] == '%':
-                    tile = Tile('coral', x, y)
-                elif self.map_list[y][x] == '-':
-                    tile = WinTile('empty', x, y, True)
-                elif self.map_list[y][x] == '$':
-                    tile = BubbleGenerator('bubblegen', x, y, True)
-                elif self.map_list[y][x] == '^':
-                    tile = OxyTile('empty', x, y, True)
-                elif self.map_list[y][x] == '@':
-                    tile = Tile('empty', x, y, True)
-                    turtle_obj = Turtle(x, y, turtle_anim)
-                self.tiles.append(tile)
-        return turtle_obj, x, y
+        if map_file.endswith('.lvl'):
+            cells, cols, rows, self.entities = load_compiled_level(map_file)
+        else:
+            self.map_list = load_level(map_file)
+            rows, cols = len(self.map_list), len(self.map_list[0])
+            cells = ''.join(self.map_list).encode()
+            self.entities = find_entities(cells, cols)
+        self.size_x, self.size_y = rows, cols
+        self.grid = TileGrid(cells, cols, rows)
+
+    def generate_map(self, render=True, layer=None):
+        global level_grid, level_layer, level_bubbles, level_world, level_wheel, level_nav
+        level_grid = self.grid
+        level_bubbles = BubbleSystem(bubble_anim, self.grid)
+        level_wheel = TimingWheel()
+        level_nav = Navigator(self.grid)
+        # стены, кораллы и пустые клетки рисуются слоем, спрайтами остаются только живые тайлы
+        if layer is None and render:
+            layer = StaticLayer(self.grid)
+        level_layer = layer
+        turtle_obj = None
+        for kind, x, y in self.entities:
+            if kind == ord('@'):
+                turtle_obj = Turtle(x, y, turtle_anim)
+        level_world = ChunkedWorld(self, level_layer)
+        level_world.update(turtle_obj.rect)
+        return turtle_obj, self.size_y - 1, self.size_x - 1
+
+
+class ChunkedWorld:
+    # живыми держатся только чанки рядом с черепахой: генераторы создаются при подходе,
+    # а при удалении выгружаются вместе с запечёнными поверхностями
+    def __init__(self, level, layer=None):
+        self.layer = layer
+        self.grid = level.grid
+        self.entities = {}
+        for kind, x, y in level.entities:
+            if kind == ord('$'):
+                self.entities.setdefault((x // CHUNK_SIZE, y // CHUNK_SIZE), []).append((x, y))
+        self.active = {}
+        self.saved = {}
+        self.center = None
+
+    def update(self, rect):
+        center = (rect.centerx // (CHUNK_SIZE * T_WIDTH), rect.centery // (CHUNK_SIZE * T_HEIGHT))
+        if center == self.center:
+            return
+        self.center = center
+        wanted = chunks_around(self.grid, center, ACTIVE_RADIUS)
+        keep = chunks_around(self.grid, center, KEEP_RADIUS)
+        for key in [key for key in self.active if key not in keep]:
+            self.evict(key)
+        for key in wanted:
+            if key not in self.active:
+                self.materialize(key)
+        if self.layer is not None:
+            self.layer.retain(keep, wanted)
+
+    def materialize(self, key):
+        # для выгруженного генератора хранится тик следующего пузыря; пропущенное время
+        # проматывается целыми периодами, а не тиками
+        period = BubbleGenerator.cd_max + 1
+        generators = []
+        for x, y in self.entities.get(key, ()):
+            generator = BubbleGenerator('bubblegen', x, y)
+            due = self.saved.pop((x, y), period)
+            generator.wake((due - level_wheel.now - 1) % period + 1)
+            generators.append(generator)
+        self.active[key] = generators
+
+    def evict(self, key):
+        for generator in self.active.pop(key):
+            self.saved[generator.rect.x // T_WIDTH, generator.rect.y // T_HEIGHT] = generator.due
+            generator.sleep()
+            generator.kill()
+
+    def get_state(self):
+        # живые чанки запоминаются вместе с объектами генераторов, отсчёты - для всех генераторов
+        period = BubbleGenerator.cd_max + 1
+        countdowns = {pos: period - 1 - (due - level_wheel.now - 1) % period for pos, due in self.saved.items()}
+        for generators in self.active.values():
+            for generator in generators:
+                countdowns[generator.rect.x // T_WIDTH, generator.rect.y // T_HEIGHT] = generator.countdown
+        return {key: list(generators) for key, generators in self.active.items()}, countdowns, self.center
+
+    def set_state(self, state):
+        # генераторы из снимка возвращаются в группы и планируются заново, новые объекты не создаются
+        active, countdowns, center = state
+        for generators in self.active.values():
+            for generator in generators:
+                generator.sleep()
+                generator.kill()
+        period = BubbleGenerator.cd_max + 1
+        self.saved = {pos: level_wheel.now + period - countdown for pos, countdown in countdowns.items()}
+        self.active = {}
+        for key, generators in active.items():
+            for generator in generators:
+                generator.add(all_sprites, bubble_gen_sprites)
+                due = self.saved.pop((generator.rect.x // T_WIDTH, generator.rect.y // T_HEIGHT))
+                generator.wake(due - level_wheel.now)
+            self.active[key] = list(generators)
+        self.center = center
 
 
 class Mob(pygame.sprite.Sprite):
-    def __init__(self, x, y, sheets):  # sheets = list[tuple[name: str, file: pygame.image, cols: int, rows: int]]
+    STATE = ('rect', 'prev_rect', 'image', 'frame', 'sheet', 'countdown', 'x_speed', 'y_speed', 'gravity')
+
+    def __init__(self, x, y, sheets):  # sheets = list[tuple[name: str, file: str, cols: int, rows: int]]
         super(Mob, self).__init__(all_sprites, mob_sprites)
         self.frame = 0
-        self.sheets = {}
-        for name, sheet, cols, rows in sheets:
-            self.cut_sheet(name, sheet, cols, rows)
+        self.sheets = animations.get(sheets)
         self.sheet = 'err'
         self.image = self.sheets[self.sheet][self.frame]
         self.rect = self.image.get_rect().move(x * T_WIDTH, y * T_HEIGHT)
+        self.prev_rect = self.rect.copy()
         self.x_speed = 0
         self.y_speed = 0
         self.gravity = 1
         self.countdown = 0
         self.anim_speed = 3
+        self.bars = []  # (полоска, показатель), рисуются слоем hud
+
+    def get_state(self):
+        return [value.copy() if isinstance(value, pygame.Rect) else value
+                for value in (getattr(self, name) for name in self.STATE)]
 
-    def cut_sheet(self, name, sheet, columns, rows):
-        if 'err' not in self.sheets.keys():
-            self.sheets['err'] = [assets['err'].subsurface(pygame.Rect(
-                (0, 0), assets['err'].get_size()))]
-        self.sheets[name] = []
-        self.rect = pygame.Rect(0, 0, sheet.get_width() // columns,
-                                sheet.get_height() // rows)
-        for j in range(rows):
-            for i in range(columns):
-                frame_location = (self.rect.w * i, self.rect.h * j)
-                self.sheets[name].append(sheet.subsurface(pygame.Rect(
-                    frame_location, self.rect.size)))
+    def set_state(self, state):
+        for name, value in zip(self.STATE, state):
+            setattr(self, name, value.copy() if isinstance(value, pygame.Rect) else value)
+
+    def lerp(self, alpha):
+        # положение между двумя тиками симуляции для отрисовки
+        return self.rect.move(round((self.prev_rect.x - self.rect.x) * (1 - alpha)),
+                              round((self.prev_rect.y - self.rect.y) * (1 - alpha)))
 
     def update(self):
         if self.countdown >= self.anim_speed:
@@ -200,6 +767,8 @@ class Mob(pygame.sprite.Sprite):
 
 
 class Turtle(Mob):
+    STATE = Mob.STATE + ('direction', 'falling', 'jumping', 'moving', 'hp', 'oxy')
+
     def __init__(self, x, y, sheets):
         super().__init__(x, y, sheets)
         self.sheet = 'run_right'
@@ -215,6 +784,7 @@ class Turtle(Mob):
         self.healthbar = Bar(self, 0, self.rect.h // 2 + 5, self.rect.width, 10)
         self.oxybar = Bar(self, 0, self.rect.h // 2 + 20, self.rect.width, 10,
                           pygame.color.Color("#00B7EB"), pygame.color.Color("#808080"))
+        self.bars = [(self.healthbar, 'hp'), (self.oxybar, 'oxy')]
 
     def run_right(self):
         self.direction = 'run_right'
@@ -236,10 +806,12 @@ class Turtle(Mob):
         self.jumping = False
         self.falling = True
         self.y_speed = 0
-        print("actfall")
+        if trace.physics:
+            trace.emit('physics', 'actfall')
 
-    def hook_keyboard(self):
-        keys = pygame.key.get_pressed()
+    def hook_keyboard(self, keys=None):
+        if keys is None:
+            keys = pygame.key.get_pressed()
         self.x_speed = 0
         self.moving = False
         if keys[pygame.K_a]:
@@ -256,89 +828,57 @@ class Turtle(Mob):
             if self.hp < 0:
                 self.hp = 20
 
-    def is_collide_flat(self):
-        if pygame.sprite.spritecollideany(self, solid_sprites):
-            target = pygame.sprite.spritecollide(self, solid_sprites, False)[0]
-            if self.rect.left < target.rect.right and self.x_speed < 0:
-                self.rect.left = target.rect.right
-                self.x_speed = 0
-                print('rightx')
-            elif self.rect.right > target.rect.left and self.x_speed > 0:
-                self.rect.right = target.rect.left
-                self.x_speed = 0
-                print('leftx')
-
-    def is_collide_updown(self):
-        if not pygame.sprite.spritecollideany(self, solid_sprites):
-            return
-        target = pygame.sprite.spritecollide(self, solid_sprites, False)[0]
-        if win_sprites in target.groups():
-            return
-        # pygame.draw.rect(screen, pygame.color.Color(0, 255, 0), target.rect)
-        if self.rect.top < target.rect.bottom and self.y_speed < 0:
-            print(self.y_speed)
-            self.rect.top = target.rect.bottom
-            self.fall()
-        elif self.rect.bottom > target.rect.top and self.y_speed >= 0 and not self.jumping and self.falling:
-            self.rect.bottom = target.rect.top
-            self.falling = False
-            self.y_speed = 0
-            print('s1')
-
-    def will_fall(self):
-        self.rect = self.rect.move(0, 2)
-        if pygame.sprite.spritecollideany(self, solid_sprites):
-            target = pygame.sprite.spritecollide(self, solid_sprites, False)[0]
-            if self.rect.bottom > target.rect.top:
-                self.rect = self.rect.move(0, -2)
-                return False
-        else:
-            self.rect = self.rect.move(0, -2)
-            return True
-
     def apply_movement(self):
-        if self.will_fall() and not self.falling and not self.jumping:
+        # оси разбираются по очереди, сдвиг обрезается по первой сплошной клетке на пути
+        if not self.falling and not self.jumping and level_grid.sweep(self.rect, 0, 2) == 2:
+            # под черепахой пусто
             self.falling = True
-            print("willfall")
-        if self.direction == 'run_right':
-            self.rect = self.rect.move(self.x_speed, 0)
-            self.is_collide_flat()
-        elif self.direction == 'run_left':
-            self.rect = self.rect.move(self.x_speed, 0)
-            self.is_collide_flat()
+            if trace.physics:
+                trace.emit('physics', 'willfall')
+        dx = level_grid.sweep(self.rect, self.x_speed, 0)
+        if dx != self.x_speed:
+            if trace.collision:
+                trace.emit('collision', 'leftx' if self.x_speed > 0 else 'rightx')
+            self.x_speed = 0
+        self.rect = self.rect.move(dx, 0)
         if self.jumping:
             self.y_speed += self.gravity
-            print("jump")
+            if trace.physics:
+                trace.emit('physics', 'jump')
             if self.y_speed >= 0:
+                # верхняя точка прыжка, в этом же тике начинается падение
                 self.jumping = False
                 self.falling = True
-                self.apply_movement()
-                print("j-")
-                return
-            self.rect = self.rect.move(0, self.y_speed)
-            self.is_collide_updown()
-        elif self.falling:
+                if trace.physics:
+                    trace.emit('physics', 'j-')
+        if self.falling:
             self.y_speed += self.gravity
-            self.rect = self.rect.move(0, self.y_speed)
-            self.is_collide_updown()
+        if not self.jumping and not self.falling:
+            return
+        dy = level_grid.sweep(self.rect, 0, self.y_speed)
+        self.rect = self.rect.move(0, dy)
+        if dy == self.y_speed:
+            return
+        if self.y_speed < 0:
+            if trace.collision:
+                trace.emit('collision', 'ceiling', self.y_speed)
+            self.fall()
+        else:
+            self.falling = False
+            self.y_speed = 0
+            if trace.collision:
+                trace.emit('collision', 's1')
 
     def handle_bubbles(self):
         global bubbles_eaten
-        touched = []
-        for sprite in bubbles_sprites:
-            if pygame.sprite.collide_rect(self, sprite):
-                touched.append(sprite)
-        if not touched:
+        eaten = level_bubbles.eat(self.rect)
+        if not eaten:
             return
-        for sprite in touched:
-            if sprite.dying:
-                continue
-            self.oxy = min(self.oxy_max, self.oxy + 400)
-            bubbles_eaten += 1
-            sprite.pop()
+        self.oxy = min(self.oxy_max, self.oxy + 400 * eaten)
+        bubbles_eaten += eaten
 
     def handle_health(self):
-        if pygame.sprite.spritecollideany(self, oxytile_sprites):
+        if level_grid.collide(self.rect, OXY_CELLS):
             return
         self.oxy = max(0, self.oxy - 10)
         if self.oxy <= 0:
@@ -346,97 +886,159 @@ class Turtle(Mob):
 
     def update(self):
         # pygame.draw.rect(screen, pygame.color.Color(255, 0, 0), self.rect)
-        self.healthbar.update(self.hp_max, self.hp)
-        self.oxybar.update(self.oxy_max, self.oxy)
+        self.prev_rect = self.rect.copy()
         self.apply_movement()
         self.handle_bubbles()
         self.handle_health()
-        if self.falling:
-            print("fa")
-        if self.jumping:
-            print("jp")
+        if trace.physics and (self.falling or self.jumping):
+            trace.emit('physics', 'fa' if self.falling else 'jp')
         if self.falling or self.jumping or self.moving:
             super().update()
 
 
-class Object(pygame.sprite.Sprite):
-    def __init__(self, x, y, sheets):  # sheets = list[tuple[name: str, file: pygame.image, cols: int, rows: int]]
-        super().__init__(all_sprites)
-        self.frame = 0
-        self.sheets = {}
-        for name, sheet, cols, rows in sheets:
-            self.cut_sheet(name, sheet, cols, rows)
-        self.sheet = 'fly'
-        self.image = self.sheets[self.sheet][self.frame]
-        self.rect = self.image.get_rect().move(x, y)
-        self.countdown = 0
-        self.anim_speed = 3
-
-    def cut_sheet(self, name, sheet, columns, rows):
-        if 'err' not in self.sheets.keys():
-            self.sheets['err'] = [assets['err'].subsurface(pygame.Rect(
-                (0, 0), assets['err'].get_size()))]
-        self.sheets[name] = []
-        self.rect = pygame.Rect(0, 0, sheet.get_width() // columns,
-                                sheet.get_height() // rows)
-        for j in range(rows):
-            for i in range(columns):
-                frame_location = (self.rect.w * i, self.rect.h * j)
-                self.sheets[name].append(sheet.subsurface(pygame.Rect(
-                    frame_location, self.rect.size)))
+class Seeker(Mob):
+    # основа для существ с ИИ: плывёт к черепахе по общему полю направлений, без гравитации
+    def __init__(self, x, y, sheets, speed=4):
+        super().__init__(x, y, sheets)
+        self.add(ai_sprites)
+        self.speed = speed
+        self.gravity = 0
+
+    def steer(self):
+        dx, dy = level_nav.steer(self.rect)
+        col, row = self.rect.centerx // T_WIDTH, self.rect.centery // T_HEIGHT
+        # поперёк хода держимся середины клетки, чтобы не цепляться за углы
+        x_off = (col * T_WIDTH + T_WIDTH // 2) - self.rect.centerx
+        y_off = (row * T_HEIGHT + T_HEIGHT // 2) - self.rect.centery
+        self.x_speed = dx * self.speed if dx else max(-self.speed, min(self.speed, x_off))
+        self.y_speed = dy * self.speed if dy else max(-self.speed, min(self.speed, y_off))
 
     def update(self):
-        if self.countdown == self.anim_speed:
-            self.frame = (self.frame + 1) % len(self.sheets[self.sheet])
-            self.image = self.sheets[self.sheet][self.frame]
-            self.rect = self.image.get_rect().move(self.rect.x, self.rect.y)
-            self.countdown = 0
-        else:
-            self.countdown += 1
+        self.prev_rect = self.rect.copy()
+        self.steer()
+        self.rect = self.rect.move(level_grid.sweep(self.rect, self.x_speed, 0), 0)
+        self.rect = self.rect.move(0, level_grid.sweep(self.rect, 0, self.y_speed))
+        super().update()
 
 
-class Bubble(Object):
-    def __init__(self, x, y, sheets, duration):
-        super().__init__(x, y, sheets)
-        self.sheet = 'fly'
-        self.add(bubbles_sprites)
-        self.duration = duration
-        self.gravity = -1
-        self.dying = False
-        print(self.rect.x, self.rect.y)
-
-    def is_collide_updown(self):
-        if not pygame.sprite.spritecollideany(self, solid_sprites):
-            return
-        target = pygame.sprite.spritecollide(self, solid_sprites, False)[0]
-        if win_sprites in target.groups():
-            self.pop()
-            return
-        # pygame.draw.rect(screen, pygame.color.Color(255, 255, 0), target.rect)
-        # if self.rect.top < target.rect.bottom:
-        # self.rect.top = target.rect.bottom
+class BubbleSystem:
+    # все пузыри уровня хранятся в параллельных массивах и обновляются одним проходом
+    def __init__(self, sheets, grid):
+        self.sheets = animations.get(sheets)
+        self.grid = grid
+        self.probe = self.sheets['fly'][0].get_rect()
+        self.anim_speed = 3
+        self.x = array('i')
+        self.y = array('i')
+        self.ceiling = array('i')
+        self.duration = array('i')
+        self.frame = array('b')
+        self.countdown = array('b')
+        self.dying = array('b')
+        self.alive = array('b')
+        self.free = []
+
+    def __len__(self):
+        return len(self.alive) - len(self.free)
+
+    def get_state(self):
+        fields = (self.x, self.y, self.ceiling, self.duration, self.frame, self.countdown, self.dying, self.alive)
+        return [field[:] for field in fields], self.free[:]
+
+    def set_state(self, state):
+        fields, free = state
+        self.x, self.y, self.ceiling, self.duration, self.frame, self.countdown, self.dying, self.alive = \
+            [field[:] for field in fields]
+        self.free = free[:]
+
+    def spawn(self, x, y, duration):
+        # пузырь летит строго вверх, поэтому высота, на которой он упрётся в потолок, известна сразу
+        probe = self.probe
+        probe.topleft = x, y
+        if self.grid.collide(probe.move(0, -1)):
+            ceiling = y - 1
+        else:
+            ceiling = y - 1 + self.grid.sweep(probe, 0, -probe.bottom)
+        # место лопнувшего пузыря занимает новый, массивы растут только до пика
+        if self.free:
+            i = self.free.pop()
+            self.x[i], self.y[i], self.ceiling[i], self.duration[i] = x, y, ceiling, duration
+            self.frame[i] = self.countdown[i] = self.dying[i] = 0
+            self.alive[i] = 1
+        else:
+            for field, value in ((self.x, x), (self.y, y), (self.ceiling, ceiling), (self.duration, duration),
+                                 (self.frame, 0), (self.countdown, 0), (self.dying, 0), (self.alive, 1)):
+                field.append(value)
+        if trace.bubbles:
+            trace.emit('bubbles', 'spawn', x, y)
 
-    def apply_movement(self):
-        self.rect = self.rect.move(0, self.gravity)
-        self.is_collide_updown()
+    def pop(self, i):
+        self.dying[i] = 1
+        self.countdown[i] = 0
 
-    def pop(self):
-        self.sheet = 'pop'
-        self.dying = True
-        self.countdown = 0
-        self.anim_speed = 3
+    def kill(self, i):
+        self.alive[i] = 0
+        self.free.append(i)
 
     def update(self):
-        self.apply_movement()
-        if self.countdown == self.anim_speed:
-            self.duration -= 1
-            print(self.duration, self.sheet, self.frame, len(self.sheets[self.sheet]))
-            if self.duration <= 0 and not self.dying:
-                self.pop()
-            if self.dying and self.frame == len(self.sheets[self.sheet]) - 1:
-                self.kill()
-        super().update()
-        # print('upd')
+        fly, burst = len(self.sheets['fly']), len(self.sheets['pop'])
+        for i in range(len(self.alive)):
+            if not self.alive[i]:
+                continue
+            self.y[i] -= 1
+            if not self.dying[i] and self.y[i] <= self.ceiling[i]:
+                # упёрся в потолок
+                self.pop(i)
+            frames = burst if self.dying[i] else fly
+            if self.countdown[i] == self.anim_speed:
+                self.duration[i] -= 1
+                if trace.bubbles:
+                    trace.emit('bubbles', i, self.duration[i], 'pop' if self.dying[i] else 'fly', self.frame[i])
+                if self.duration[i] <= 0 and not self.dying[i]:
+                    self.pop(i)
+                    frames = burst
+                if self.dying[i] and self.frame[i] == frames - 1:
+                    self.kill(i)
+                    continue
+            if self.countdown[i] == self.anim_speed:
+                self.frame[i] = (self.frame[i] + 1) % frames
+                self.countdown[i] = 0
+            else:
+                self.countdown[i] += 1
+
+    def eat(self, rect):
+        eaten = 0
+        probe = self.probe
+        for i in range(len(self.alive)):
+            if not self.alive[i] or self.dying[i]:
+                continue
+            probe.topleft = self.x[i], self.y[i]
+            if probe.colliderect(rect):
+                self.pop(i)
+                eaten += 1
+        return eaten
+
+    def rects(self, camera, alpha=1.0):
+        lag = round(1 - alpha)
+        size = self.probe.size
+        return [pygame.Rect(self.x[i] + camera.dx, self.y[i] + camera.dy + lag, *size)
+                for i in range(len(self.alive)) if self.alive[i]]
+
+    def draw(self, surface, camera, alpha=1.0):
+        view = surface.get_clip()
+        w, h = self.probe.size
+        fly, burst = self.sheets['fly'], self.sheets['pop']
+        # за тик пузырь поднимается на 1 пиксель
+        dx, dy = camera.dx, camera.dy + round(1 - alpha)
+        blits = []
+        for i in range(len(self.alive)):
+            if not self.alive[i]:
+                continue
+            x, y = self.x[i] + dx, self.y[i] + dy
+            if view.left - w < x < view.right and view.top - h < y < view.bottom:
+                blits.append(((burst if self.dying[i] else fly)[self.frame[i]], (x, y)))
+        surface.blits(blits, doreturn=False)
+        return len(blits)
 
 
 class Bar:
@@ -448,24 +1050,283 @@ class Bar:
         self.size = (x_size, y_size)
         self.fcolor = full_color
         self.ncolor = none_color
+        self.image = None
+        self.fill = None
 
-    def update(self, full, remain):
-        if self.target is None:
-            self.x = self.x_off
-            self.y = self.y_off
-        else:
-            self.x = self.target.rect.x + self.x_off
-            self.y = self.target.rect.y + self.y_off
+    def render(self, full, remain):
+        # заливка перерисовывается, только если изменилась её ширина в пикселях
         fxsize = int(self.size[0] * min(full, max(0, remain)) / full)
-        pygame.draw.rect(screen, self.fcolor, pygame.rect.Rect(self.x, self.y,
-                                                               fxsize, self.size[1]))
+        if self.image is None or self.image.get_size() != self.size:
+            self.image = pygame.Surface(self.size)
+            self.fill = None
+        if fxsize != self.fill:
+            self.fill = fxsize
+            self.image.fill(self.ncolor)
+            self.image.fill(self.fcolor, (0, 0, fxsize, self.size[1]))
+        return self.image
+
+    def area(self, alpha=1.0):
+        if self.target is None:
+            return pygame.Rect(self.x_off, self.y_off, *self.size)
+        rect = self.target.lerp(alpha)
+        return pygame.Rect(rect.x + self.x_off, rect.y + self.y_off, *self.size)
+
+
+class Hud:
+    # полоски всех мобов поверх мира, в экранных координатах и одним вызовом blits
+    def rects(self, camera, alpha=1.0):
+        return [camera.apply(bar.area(alpha)) for mob in mob_sprites for bar, stat in mob.bars]
+
+    def draw(self, surface, camera, alpha=1.0):
+        blits = [(bar.render(getattr(mob, stat + '_max'), getattr(mob, stat)), camera.apply(bar.area(alpha)))
+                 for mob in mob_sprites for bar, stat in mob.bars]
+        surface.blits(blits, doreturn=False)
+        return len(blits)
+
+
+hud = Hud()
+
+
+class FrameProfiler:
+    # время фаз кадра в мс: скользящие p50/p99, оверлей и покадровая выгрузка в CSV
+    # или JSON Lines; кадры пишутся в файл пачками, как в Trace
+    PHASES = ('input', 'turtle', 'mobs', 'generators', 'win', 'bubbles',
+              'camera', 'static', 'sprites', 'draw_bubbles', 'hud', 'flip')
+
+    def __init__(self, window=120, batch=300):
+        self.enabled = False
+        self.overlay = False
+        self.file = None
+        self.batch = batch
+        self.columns = None
+        self.samples = {phase: deque(maxlen=window) for phase in self.PHASES + ('frame',)}
+        self.history = []
+        self.frame = {}
+        self.mark = self.start = 0
+        self.bars = {}
+        self.font = None
+
+    def enable(self, file=None):
+        self.enabled = True
+        if file is not None and self.file is None:
+            atexit.register(self.flush)
+        self.file = file
+
+    def toggle(self):
+        self.overlay = not self.overlay
+        if self.overlay and not self.enabled:
+            self.enabled = True
+            self.begin()
+
+    def begin(self):
+        if not self.enabled:
+            return
+        self.frame = {phase: 0.0 for phase in self.PHASES}
+        self.mark = self.start = perf_counter()
+
+    def lap(self, phase):
+        if not self.enabled:
+            return
+        now = perf_counter()
+        self.frame[phase] += (now - self.mark) * 1000
+        self.mark = now
 
-        pygame.draw.rect(screen, self.ncolor, pygame.rect.Rect(self.x + fxsize,
-                                                               self.y, self.size[0] - fxsize, self.size[1]))
+    def count(self, name, value):
+        if self.enabled:
+            self.frame[name] = self.frame.get(name, 0) + value
+
+    def end(self):
+        if not self.enabled:
+            return
+        self.frame['frame'] = (perf_counter() - self.start) * 1000
+        for phase, samples in self.samples.items():
+            samples.append(self.frame[phase])
+        if self.file is not None:
+            self.history.append(self.frame)
+            if len(self.history) >= self.batch:
+                self.flush()
+
+    def percentile(self, phase, p):
+        samples = sorted(self.samples[phase])
+        if not samples:
+            return 0.0
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+    def draw(self, surface):
+        if not self.overlay or not self.enabled:
+            return
+        if self.font is None:
+            self.font = pygame.font.Font(None, 18)
+        budget = 1000 / FPS
+        y = 5
+        for phase in self.PHASES + ('frame',):
+            p50, p99 = self.percentile(phase, 50), self.percentile(phase, 99)
+            if phase not in self.bars:
+                self.bars[phase] = Bar(None, 0, 0, 100, 10, pygame.color.Color("#FFA500"),
+                                       pygame.color.Color("#404040"))
+            surface.blit(self.bars[phase].render(budget, p99), (5, y))
+            line = f"{phase}: p50 {p50:.2f} p99 {p99:.2f} ms"
+            surface.blit(self.font.render(line, 1, pygame.Color('white')), (110, y))
+            y += 14
+        counts = f"sprites {self.frame.get('sprites_count', 0)}  blits {self.frame.get('blits', 0)}"
+        surface.blit(self.font.render(counts, 1, pygame.Color('white')), (5, y))
+
+    def flush(self):
+        if self.file is None or not self.history:
+            return
+        # первая пачка начинает файл заново и задаёт колонки
+        first = self.columns is None
+        if first:
+            self.columns = list(self.history[0].keys())
+        with open(self.file, 'w' if first else 'a', newline='') as out:
+            if self.file.endswith('.json'):
+                for frame in self.history:
+                    out.write(json.dumps(frame) + '\n')
+            else:
+                writer = csv.DictWriter(out, self.columns, extrasaction='ignore')
+                if first:
+                    writer.writeheader()
+                writer.writerows(self.history)
+        self.history.clear()
+
+
+profiler = FrameProfiler()
+if os.environ.get('TURTLE_PROFILE'):
+    # например TURTLE_PROFILE=frames.csv; F3 в игре показывает оверлей
+    profiler.enable(os.environ['TURTLE_PROFILE'])
+
+
+class Inflector:
+    # согласование слов с числом: pymorphy2 импортируется и грузит словари один раз за процесс
+    FALLBACK = {'пузырёк': ('пузырёк', 'пузырька', 'пузырьков')}
+
+    def __init__(self):
+        self.analyzer = None
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def warm_up(self):
+        background_loader.submit(self.load)
+
+    def load(self):
+        with self.lock:
+            if self.analyzer is None:
+                try:
+                    import pymorphy2
+                    self.analyzer = pymorphy2.MorphAnalyzer()
+                except (ImportError, AttributeError):
+                    # pymorphy2 не установлен или не работает на этой версии Python
+                    self.analyzer = False
+        return self.analyzer
+
+    def agree(self, word, number):
+        key = (word, number)
+        if key not in self.cache:
+            analyzer = self.load()
+            if analyzer:
+                self.cache[key] = analyzer.parse(word)[0].make_agree_with_number(number).word
+            else:
+                self.cache[key] = self.plural(word, number)
+        return self.cache[key]
+
+    def plural(self, word, number):
+        if word not in self.FALLBACK:
+            return word
+        one, few, many = self.FALLBACK[word]
+        if number % 10 == 1 and number % 100 != 11:
+            return one
+        if 2 <= number % 10 <= 4 and not 12 <= number % 100 <= 14:
+            return few
+        return many
+
+
+inflector = Inflector()
+
+
+class DirtyRects:
+    # пока камера стоит, перерисовываются только области, где что-то сдвинулось
+    def __init__(self):
+        self.prev = []
+        self.view = None
+
+    def invalidate(self):
+        self.view = None
+
+    def collect(self, view, rects):
+        # view - всё, от чего зависит кадр целиком: смещение камеры, слой уровня, оверлей
+        full = view != self.view
+        self.view = view
+        dirty = self.prev + rects
+        self.prev = rects
+        if full:
+            return None
+        # пересекающиеся области сливаются, остальные перерисовываются по отдельности
+        view = screen.get_rect()
+        merged = []
+        for rect in dirty:
+            rect = rect.clip(view)
+            if not rect:
+                continue
+            i = rect.collidelist(merged)
+            while i != -1:
+                rect = rect.union(merged.pop(i))
+                i = rect.collidelist(merged)
+            merged.append(rect)
+        return merged
+
+
+dirty_rects = DirtyRects()
+
+
+class Snapshot:
+    # состояние уровня на момент снимка: рестарт и продолжение прогона с контрольной точки
+    # без чтения файла и пересборки уровня, только O(сущностей) копирование
+    def __init__(self):
+        self.level = (current_map, map_idx, map_size, level_grid, level_layer, level_world, level_bubbles,
+                      level_wheel, level_nav, turtle)
+        # все мобы уровня: черепаха и существа с ИИ
+        self.mobs = [(mob, mob.get_state(), mob in ai_sprites) for mob in mob_sprites]
+        # тик колеса тоже часть состояния: новые генераторы берут фазу от старта уровня
+        self.tick = level_wheel.now
+        self.generators = level_world.get_state()
+        self.bubbles = level_bubbles.get_state()
+        self.bubbles_eaten = bubbles_eaten
+
+    def restore(self):
+        global current_map, map_idx, map_size, level_grid, level_layer, level_world, level_bubbles, level_wheel, \
+            level_nav, turtle, bubbles_eaten
+        current_map, map_idx, map_size, level_grid, level_layer, level_world, level_bubbles, level_wheel, \
+            level_nav, turtle = self.level
+        init_groups()
+        for mob, state, ai in self.mobs:
+            mob.add(all_sprites, mob_sprites)
+            if ai:
+                mob.add(ai_sprites)
+            mob.set_state(state)
+        level_wheel.reset(self.tick)
+        level_world.set_state(self.generators)
+        level_world.update(turtle.rect)
+        level_bubbles.set_state(self.bubbles)
+        bubbles_eaten = self.bubbles_eaten
+        dirty_rects.invalidate()
 
 
 # ----------------------------
 
+def wait_for_input():
+    # экран неподвижен: ждём события, а не перерисовываем его в цикле
+    pygame.display.flip()
+    while True:
+        event = pygame.event.wait()
+        if event.type == pygame.QUIT:
+            sys.exit()
+        elif event.type == pygame.KEYDOWN or \
+                event.type == pygame.MOUSEBUTTONDOWN:
+            return
+        elif event.type == pygame.VIDEOEXPOSE:
+            pygame.display.flip()
+
+
 def start_screen():
     intro_text = ["ЧЕРЕПАШКА - В ПОИСКАХ ДОМА", "",
                   "Правила игры:",
@@ -473,7 +1334,7 @@ def start_screen():
                   "Управление: влево/вправо - AD, прыжок - Пробел",
                   "Задыхаетесь? Подберите пузыри из подводных залежей воздуха"]
 
-    fon = pygame.transform.scale(load_image('bg.jpg'), (WIDTH, HEIGHT))
+    fon = load_image('bg.jpg', size=(WIDTH, HEIGHT))
     screen.blit(fon, (0, 0))
     font = pygame.font.Font(None, 30)
     text_coord = 50
@@ -486,24 +1347,15 @@ def start_screen():
         text_coord += intro_rect.height
         screen.blit(string_rendered, intro_rect)
 
-    while True:
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                sys.exit()
-            elif event.type == pygame.KEYDOWN or \
-                    event.type == pygame.MOUSEBUTTONDOWN:
-                return
-        pygame.display.flip()
-        CLOCK.tick(FPS)
+    wait_for_input()
 
 
 def win_screen():
     intro_text = ["Вы выиграли!", "",
                   "Поздравляю, вы спасли черепашку,",
-                  f"собрав при этом {bubbles_eaten} "
-                  f"{pymorphy2.MorphAnalyzer().parse('пузырёк')[0].make_agree_with_number(bubbles_eaten).word}!"]
+                  f"собрав при этом {bubbles_eaten} {inflector.agree('пузырёк', bubbles_eaten)}!"]
 
-    fon = pygame.transform.scale(load_image('bg.jpg'), (WIDTH, HEIGHT))
+    fon = load_image('bg.jpg', size=(WIDTH, HEIGHT))
     screen.blit(fon, (0, 0))
     font = pygame.font.Font(None, 30)
     text_coord = 50
@@ -516,15 +1368,8 @@ def win_screen():
         text_coord += intro_rect.height
         screen.blit(string_rendered, intro_rect)
 
-    while True:
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                sys.exit()
-            elif event.type == pygame.KEYDOWN or \
-                    event.type == pygame.MOUSEBUTTONDOWN:
-                sys.exit()
-        pygame.display.flip()
-        CLOCK.tick(FPS)
+    wait_for_input()
+    sys.exit()
 
 
 def death_screen():
@@ -532,7 +1377,7 @@ def death_screen():
                   "Черепашка не вернулась домой",
                   "Попробуйте ещё раз!"]
 
-    fon = pygame.transform.scale(load_image('bg.jpg'), (WIDTH, HEIGHT))
+    fon = load_image('bg.jpg', size=(WIDTH, HEIGHT))
     screen.blit(fon, (0, 0))
     font = pygame.font.Font(None, 30)
     text_coord = 50
@@ -545,83 +1390,200 @@ def death_screen():
         text_coord += intro_rect.height
         screen.blit(string_rendered, intro_rect)
 
-    while True:
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                sys.exit()
-            elif event.type == pygame.KEYDOWN or \
-                    event.type == pygame.MOUSEBUTTONDOWN:
-                return
-        pygame.display.flip()
-        CLOCK.tick(FPS)
+    wait_for_input()
 
 
-# ----------- INIT -----------
-
-pygame.init()
-screen = pygame.display.set_mode(SIZE)
-
 # ---------- ASSETS ----------
 
-assets = {
-    'empty': load_image('empty.png'),
-    'wall': load_image('sand_type1.png'),
-    'coral': load_image('sand_type2.png'),
-    'err': load_image('err.png'),
-    'bg': pygame.transform.scale(load_image('bg.jpg'), (1200, 600)),
-    'bubblegen': load_image('bubblegen.png')
-}
+
+# картинки грузятся при первом использовании, здесь только имена файлов
 
 turtle_anim = [
-    ('run_left', load_image('turtle_run_left.png'), 3, 1),
-    ('run_right', load_image('turtle_run_right.png'), 3, 1)
+    ('run_left', 'turtle_run_left.png', 3, 1),
+    ('run_right', 'turtle_run_right.png', 3, 1)
 ]
 
 bubble_anim = [
-    ('fly', load_image('bubble_fly.png'), 3, 1),
-    ('pop', load_image('bubble_pop.png'), 3, 1)
+    ('fly', 'bubble_fly.png', 3, 1),
+    ('pop', 'bubble_pop.png', 3, 1)
 ]
 
+animations.register(turtle_anim, bubble_anim)
+
 maps = ['level0.txt', 'level1.txt']
+map_idx = 0
+current_map = None
+# счётчик нужен Snapshot и до первого забега (simulate/run сбрасывают его сами)
+bubbles_eaten = 0
+
+# ----------- INIT -----------
+
+
+def init(headless=False):
+    global screen
+    if headless:
+        # без окна: SDL рисует в память
+        os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    pygame.init()
+    screen = pygame.display.set_mode(SIZE)
+
 
 # ------- GAME PROCESS -------
 
-start_screen()
 
-map_idx = 0
-turtle, *map_size = Map(maps[map_idx]).generate_map()
-bubbles_eaten = 0
-camera = Camera()
+def start_level(map_file, render=True):
+    global turtle, map_size, current_map
+    current_map = map_file
+    level, layer = preloader.take(map_file, render)
+    init_groups()
+    turtle, *map_size = level.generate_map(render, layer)
+    # экран мог быть затёрт меню, первый кадр уровня рисуется целиком
+    dirty_rects.invalidate()
 
-running = True
-while running:
-    for event in pygame.event.get():
-        if event.type == pygame.QUIT:
-            running = False
-    screen.fill((0, 0, 0))
-    screen.blit(assets['bg'], (0, 0))
-    turtle.hook_keyboard()
-    for sprite in all_sprites:
-        camera.apply(sprite)
-    all_sprites.draw(screen)
+
+def enter_level(idx):
+    global map_idx
+    map_idx = idx
+    start_level(maps[map_idx])
+    if map_idx + 1 < len(maps):
+        preloader.start(maps[map_idx + 1])
+
+
+def step(keys):
+    # один тик симуляции; возвращает 'death', 'finish' или None
+    turtle.hook_keyboard(keys)
     turtle.update()
-    camera.update(turtle)
+    level_world.update(turtle.rect)
+    profiler.lap('turtle')
     if turtle.hp <= 0:
-        death_screen()
-        map_idx = 0
-        init_groups()
-        turtle, *map_size = Map(maps[map_idx]).generate_map()
-    for sprite in bubble_gen_sprites:
-        sprite.update()
-    for sprite in win_sprites:
-        if pygame.sprite.collide_rect(turtle, sprite):
-            if map_idx == len(maps) - 1:
-                win_screen()
+        return 'death'
+    level_nav.track(turtle.rect)
+    for mob in ai_sprites:
+        mob.update()
+    profiler.lap('mobs')
+    for generator in level_wheel.advance():
+        generator.fire()
+    profiler.lap('generators')
+    if level_grid.collide(turtle.rect, WIN_CELLS):
+        return 'finish'
+    profiler.lap('win')
+    level_bubbles.update()
+    profiler.lap('bubbles')
+
+
+def simulate(script=(), levels=None, max_ticks=100000, checkpoint=None):
+    # прогон без окна и клавиатуры так быстро, как позволяет процессор;
+    # с checkpoint (Snapshot) прогон продолжается с него, а не с начала первого уровня
+    global bubbles_eaten
+    levels = levels or maps
+    controls = ScriptedInput(script)
+    if checkpoint is None:
+        bubbles_eaten = 0
+        level = 0
+        start_level(levels[level], render=False)
+    else:
+        checkpoint.restore()
+        level = levels.index(current_map)
+    outcome, tick = 'timeout', 0
+    for tick in range(1, max_ticks + 1):
+        result = step(controls.next_keys())
+        if result == 'death':
+            outcome = 'death'
+            break
+        if result == 'finish':
+            if level == len(levels) - 1:
+                outcome = 'win'
                 break
-            map_idx += 1
-            init_groups()
-            turtle, *map_size = Map(maps[map_idx]).generate_map()
-    for sprite in bubbles_sprites:
-        sprite.update()
-    CLOCK.tick(FPS)
-    pygame.display.flip()
+            level += 1
+            start_level(levels[level], render=False)
+    return {'outcome': outcome, 'ticks': tick, 'level': level, 'bubbles_eaten': bubbles_eaten,
+            'hp': turtle.hp, 'oxy': turtle.oxy}
+
+
+def frame_rects(alpha=1.0):
+    # все мобы (черепаха и существа с ИИ) двигаются сами, даже когда камера стоит
+    mobs = [camera.apply(mob.lerp(alpha)) for mob in mob_sprites]
+    return mobs + hud.rects(camera, alpha) + level_bubbles.rects(camera, alpha)
+
+
+def draw_frame(alpha=1.0):
+    # возвращает список перерисованных областей или None, если перерисован весь экран
+    camera.update(turtle, alpha)
+    if profiler.overlay:
+        # цифры оверлея меняются каждый кадр, с ним кадр всегда рисуется целиком
+        dirty_rects.invalidate()
+    dirty = dirty_rects.collect((camera.dx, camera.dy, level_layer, profiler.overlay), frame_rects(alpha))
+    profiler.lap('camera')
+    profiler.count('sprites_count', len(all_sprites) + len(level_bubbles))
+    # каждая область рисуется под своим отсечением, слои пропускают то, что её не задевает
+    for clip in [None] if dirty is None else dirty:
+        screen.set_clip(clip)
+        screen.fill((0, 0, 0))
+        screen.blit(assets['bg'], (0, 0))
+        profiler.count('blits', level_layer.draw(screen, camera))
+        profiler.lap('static')
+        profiler.count('blits', camera.draw(all_sprites, screen, alpha))
+        profiler.lap('sprites')
+        profiler.count('blits', level_bubbles.draw(screen, camera, alpha))
+        profiler.lap('draw_bubbles')
+        profiler.count('blits', hud.draw(screen, camera, alpha))
+        profiler.draw(screen)
+        profiler.lap('hud')
+    screen.set_clip(None)
+    return dirty
+
+
+def run():
+    global bubbles_eaten, camera
+    init()
+    inflector.warm_up()
+    start_screen()
+
+    enter_level(0)
+    bubbles_eaten = 0
+    camera = Camera()
+    # повтор после гибели восстанавливает первый уровень из снимка
+    checkpoint = Snapshot()
+
+    running = True
+    accumulator = 0
+    while running:
+        profiler.begin()
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                running = False
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                profiler.toggle()
+        profiler.lap('input')
+        # симуляция идёт фиксированными тиками, под нагрузкой пропускаются кадры, а не тики
+        accumulator += min(CLOCK.tick(FPS), MAX_FRAME_MS)
+        while running and accumulator >= TICK_MS:
+            accumulator -= TICK_MS
+            result = step(pygame.key.get_pressed())
+            if result == 'death':
+                death_screen()
+                # счёт пузырей копится через все попытки, как и до снимков
+                eaten = bubbles_eaten
+                checkpoint.restore()
+                bubbles_eaten = eaten
+                if map_idx + 1 < len(maps):
+                    preloader.start(maps[map_idx + 1])
+                accumulator = 0
+                CLOCK.tick()
+            elif result == 'finish':
+                if map_idx == len(maps) - 1:
+                    win_screen()
+                    running = False
+                    break
+                enter_level(map_idx + 1)
+        dirty = draw_frame(accumulator / TICK_MS)
+        if dirty is None:
+            pygame.display.flip()
+        elif dirty:
+            pygame.display.update(dirty)
+        profiler.lap('flip')
+        profiler.end()
+
+
+if __name__ == '__main__':
+    run()
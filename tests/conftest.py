@@ -0,0 +1,16 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# уровни и картинки ищутся относительно data/
+os.chdir(ROOT)
+
+import main  # noqa: E402
+
+
+@pytest.fixture(scope='session', autouse=True)
+def headless():
+    main.init(headless=True)
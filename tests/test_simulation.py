@@ -0,0 +1,234 @@
+import random
+
+import pygame
+
+import main
+
+MOVES = [['d'], ['d'], ['d', 'space'], ['a'], ['a', 'space'], ['space'], []]
+
+
+def random_script(seed, ticks=3000):
+    rng = random.Random(seed)
+    return [(rng.randint(1, 30), rng.choice(MOVES)) for _ in range(ticks // 10)]
+
+
+def brute_collide(grid, rect, kinds=main.SOLID_CELLS):
+    return {(col, row) for row in range(grid.rows) for col in range(grid.cols)
+            if grid.data[row * grid.cols + col] in kinds and grid.cell_rect(col, row).colliderect(rect)}
+
+
+def test_simulate_is_deterministic():
+    for seed in range(5):
+        script = random_script(seed)
+        assert main.simulate(script, max_ticks=3000) == main.simulate(script, max_ticks=3000)
+
+
+def test_grid_collide_matches_brute_force():
+    grid = main.Map('level1.txt').grid
+    rng = random.Random(1)
+    for _ in range(300):
+        rect = pygame.Rect(rng.randint(-60, grid.cols * main.T_WIDTH), rng.randint(-60, grid.rows * main.T_HEIGHT),
+                           rng.randint(1, 120), rng.randint(1, 120))
+        hits = {(target.x // main.T_WIDTH, target.y // main.T_HEIGHT) for target, kind in grid.collide(rect)}
+        assert hits == brute_collide(grid, rect)
+
+
+def test_sweep_matches_pixel_stepping():
+    grid = main.Map('level1.txt').grid
+    rng = random.Random(2)
+    for _ in range(300):
+        rect = pygame.Rect(rng.randint(50, (grid.cols - 2) * main.T_WIDTH),
+                           rng.randint(50, (grid.rows - 2) * main.T_HEIGHT), 42, 26)
+        if grid.collide(rect):
+            continue
+        for dx, dy in ((rng.randint(-300, 300), 0), (0, rng.randint(-300, 300))):
+            step_x, step_y = (dx > 0) - (dx < 0), (dy > 0) - (dy < 0)
+            moved = 0
+            while moved != dx + dy and not grid.collide(rect.move((moved + step_x) * abs(step_x),
+                                                                  (moved + step_y) * abs(step_y))):
+                moved += step_x + step_y
+            assert grid.sweep(rect, dx, dy) == moved
+
+
+def test_bubble_pops_at_ceiling_and_frees_its_slot():
+    main.start_level('level0.txt', render=False)
+    grid = main.level_grid
+    bubbles = main.BubbleSystem(main.bubble_anim, grid)
+    size = bubbles.probe.size
+
+    def free_below(col, row):
+        # от нижнего края клетки row до двух клеток вниз пузырь ни во что не упирается
+        top = pygame.Rect(col * main.T_WIDTH, (row + 1) * main.T_HEIGHT, *size)
+        return not grid.collide(top.union(top.move(0, main.T_HEIGHT)))
+
+    # пузырь в открытой воде на клетку ниже потолка
+    col, row = next((col, row) for row in range(grid.rows - 2) for col in range(grid.cols)
+                    if grid.data[row * grid.cols + col] in main.SOLID_CELLS and free_below(col, row))
+    x, y = col * main.T_WIDTH, (row + 2) * main.T_HEIGHT
+    bubbles.spawn(x, y, 1000)
+    popped = None
+    for tick in range(1, 200):
+        bubbles.update()
+        if popped is None and bubbles.dying[0]:
+            popped = tick
+        if not bubbles.alive[0]:
+            break
+    # лопается, как только задевает стену
+    probe = pygame.Rect(x, y - popped, *size)
+    assert grid.collide(probe) and not grid.collide(probe.move(0, 1))
+    assert len(bubbles) == 0 and bubbles.free == [0]
+    bubbles.spawn(x, y, 1000)
+    assert len(bubbles.alive) == 1
+
+
+def test_bubble_expires_after_its_duration():
+    main.start_level('level0.txt', render=False)
+    bubbles = main.BubbleSystem(main.bubble_anim, main.level_grid)
+    # над черепахой на старте открытая вода, пузырь успевает выдохнуться до потолка
+    bubbles.spawn(*main.turtle.rect.midtop, 2)
+    ticks = 0
+    while bubbles.alive[0] and not bubbles.dying[0]:
+        bubbles.update()
+        ticks += 1
+    assert ticks == 2 * (bubbles.anim_speed + 1)
+
+
+def test_compiled_level_round_trip(tmp_path):
+    for name in main.maps:
+        output = str(tmp_path / (name + '.lvl'))
+        main.compile_level(name, output)
+        text, compiled = main.Map(name), main.Map(output)
+        assert bytes(compiled.grid.data) == bytes(text.grid.data)
+        assert (compiled.grid.cols, compiled.grid.rows) == (text.grid.cols, text.grid.rows)
+        assert [tuple(entity) for entity in compiled.entities] == [tuple(entity) for entity in text.entities]
+
+
+def world_state():
+    bubbles = main.level_bubbles
+    live = sorted((bubbles.x[i], bubbles.y[i], bubbles.dying[i], bubbles.frame[i])
+                  for i in range(len(bubbles.alive)) if bubbles.alive[i])
+    mobs = [tuple(mob.rect) for mob in main.mob_sprites]
+    return mobs, main.turtle.hp, main.turtle.oxy, main.bubbles_eaten, live, main.level_world.get_state()[1]
+
+
+def play(controls, ticks):
+    states = []
+    for _ in range(ticks):
+        result = main.step(controls.next_keys())
+        states.append(world_state())
+        if result:
+            break
+    return states
+
+
+def test_snapshot_restore_replays_tick_by_tick():
+    for seed in range(6):
+        script = random_script(seed)
+        fork = 40 + 37 * seed
+        # эталон: уровень с начала, черепаха бессмертна, чтобы уйти далеко по уровню
+        main.start_level('level1.txt', render=False)
+        main.turtle.hp = main.turtle.hp_max = 10 ** 9
+        main.Seeker(5, 30, main.turtle_anim)
+        controls = main.ScriptedInput(script)
+        play(controls, fork)
+        snapshot = main.Snapshot()
+        expected = play(controls, 1500)
+        # после снимка мир уводится другим вводом, затем восстанавливается и играет тот же хвост
+        play(main.ScriptedInput(random_script(seed + 100)), 700)
+        snapshot.restore()
+        controls = main.ScriptedInput(script)
+        for _ in range(fork):
+            controls.next_keys()
+        assert play(controls, 1500) == expected
+
+
+def test_simulate_forks_from_checkpoint():
+    for seed in range(30):
+        script = random_script(seed)
+        flat = [keys for ticks, keys in script for _ in range(ticks)]
+        fork = 20 + seed * 3
+        full = main.simulate(script, levels=['level1.txt'], max_ticks=3000)
+        if full['ticks'] <= fork:
+            continue
+        main.simulate(script, levels=['level1.txt'], max_ticks=fork)
+        checkpoint = main.Snapshot()
+        rest = main.simulate([(1, keys) for keys in flat[fork:]], levels=['level1.txt'],
+                             max_ticks=3000 - fork, checkpoint=checkpoint)
+        rest['ticks'] += fork
+        assert rest == full
+
+
+def test_generators_keep_level_start_phase(monkeypatch):
+    period = main.BubbleGenerator.cd_max + 1
+    fired = []
+    fire = main.BubbleGenerator.fire
+
+    def logged_fire(generator):
+        fired.append((main.level_wheel.now, generator.rect.x // main.T_WIDTH, generator.rect.y // main.T_HEIGHT))
+        fire(generator)
+
+    monkeypatch.setattr(main.BubbleGenerator, 'fire', logged_fire)
+    # дальние генераторы оживают по ходу движения вправо, но пузыри выпускают в такт старта уровня
+    for idle, first in ((0, 2 * period), (5, 3 * period), (11, 3 * period)):
+        fired.clear()
+        main.start_level('level1.txt', render=False)
+        main.turtle.hp = main.turtle.hp_max = 10 ** 9
+        controls = main.ScriptedInput([(idle, []), (400, ['d'])])
+        for _ in range(400):
+            main.step(controls.next_keys())
+        assert fired and all(tick % period == 0 for tick, x, y in fired)
+        for pos in ((48, 20), (51, 14), (57, 10)):
+            assert min(tick for tick, x, y in fired if (x, y) == pos) == first
+
+
+def bfs_distances(grid, target, radius):
+    col, row = target
+    distances = {target: 0}
+    queue = [target]
+    for x, y in queue:
+        for nx, ny in ((x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)):
+            if (nx, ny) in distances or abs(nx - col) > radius or abs(ny - row) > radius \
+                    or not (0 <= nx < grid.cols and 0 <= ny < grid.rows) \
+                    or grid.data[ny * grid.cols + nx] in main.SOLID_CELLS:
+                continue
+            distances[nx, ny] = distances[x, y] + 1
+            queue.append((nx, ny))
+    return distances
+
+
+def test_flow_field_follows_shortest_paths():
+    grid = main.Map('level1.txt').grid
+    navigator = main.Navigator(grid)
+    for target in ((23, 30), (50, 15), (70, 7)):
+        navigator.track(pygame.Rect(target[0] * main.T_WIDTH, target[1] * main.T_HEIGHT, 1, 1))
+        field = navigator.field()
+        distances = bfs_distances(grid, target, navigator.radius)
+        for (col, row), distance in distances.items():
+            # каждый шаг по полю приближает к цели ровно на клетку
+            for left in range(distance, 0, -1):
+                dx, dy = field.direction(col, row)
+                col, row = col + dx, row + dy
+                assert distances.get((col, row)) == left - 1
+            assert field.direction(col, row) == (0, 0)
+        # повторный запрос той же клетки берётся из кэша
+        navigator.track(pygame.Rect(target[0] * main.T_WIDTH, target[1] * main.T_HEIGHT, 1, 1))
+        assert navigator.field() is field
+
+
+def test_seeker_swims_to_turtle_across_level():
+    main.start_level('level1.txt', render=False)
+    turtle = main.turtle
+    turtle.hp = turtle.hp_max = 10 ** 9
+    for _ in range(60):
+        main.step(main.PressedKeys())
+    target = (turtle.rect.centerx // main.T_WIDTH, turtle.rect.centery // main.T_HEIGHT)
+    distances = bfs_distances(main.level_grid, target, main.NAV_RADIUS)
+    start = max(distances, key=distances.get)
+    assert distances[start] > 50
+    seeker = main.Seeker(*start, main.turtle_anim)
+    # на клетку уходит не больше T_WIDTH / speed тиков
+    for _ in range(distances[start] * main.T_WIDTH // seeker.speed + 1):
+        main.step(main.PressedKeys())
+        if seeker.rect.colliderect(turtle.rect):
+            break
+    assert seeker.rect.colliderect(turtle.rect)